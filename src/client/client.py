@@ -1,13 +1,17 @@
 import logging
 
-from datetime import datetime, date
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import FrozenSet, Iterator, List, Optional, Tuple
 
-from backoff import on_exception, expo
 from requests import Response
 
 from keboola.http_client import HttpClient
 
+MAX_WORKERS = 8
+# 429 and 503 responses are retried honoring their Retry-After header
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
 
 class CNBRatesClientException(Exception):
     pass
@@ -17,17 +21,18 @@ class CNBRatesClient(HttpClient):
     base_url = 'https://www.cnb.cz/cs/financni-trhy/devizovy-trh/kurzy-devizoveho-trhu/kurzy-devizoveho-trhu/denni_kurz.txt' # noqa E501
 
     def __init__(self):
-        super().__init__(base_url=self.base_url)
+        super().__init__(base_url=self.base_url, status_forcelist=RETRY_STATUS_CODES)
         self.base_url = self.base_url[:-1]
 
     # Parsers
     @staticmethod
-    def _parse_response(response: Response, temp_date: str, currencies: List[str]) -> List[List[str]]:
+    def _parse_response(response: Response, temp_date: str,
+                        currencies: Optional[FrozenSet[str]]) -> List[Tuple[str, ...]]:
         data = []
         for line in response.text.split('\n')[2:]:
             line_split = line.split('|')
             if len(line_split) == 5 and (currencies is None or line_split[3] in currencies):
-                data.append([temp_date] + line_split[:4] + [line_split[4].replace(',', '.')])
+                data.append((temp_date, *line_split[:4], line_split[4].replace(',', '.')))
         return data
 
     @staticmethod
@@ -35,20 +40,31 @@ class CNBRatesClient(HttpClient):
         if dt == today and not curr_flag:
             parse_date = response.text[:response.text.find('#')].strip().split('.')
             return f"{parse_date[2]}-{parse_date[1]}-{parse_date[0]}"
-        return dt.strftime('%Y-%m-%d')
+        return dt.isoformat()
 
     # Main API call method
-    @on_exception(expo, CNBRatesClientException, max_tries=10)
-    def get_rates(self, dates: List[datetime], today: date, curr_flag: bool, currencies: List[str]) -> List[str]:
-        data = []
+    def iter_rates(self, dates: List[date], today: date, curr_flag: bool,
+                   currencies: Optional[FrozenSet[str]]) -> Iterator[List[Tuple[str, ...]]]:
+        """
+        Yields rates rows of each requested date in the order of dates, as soon as the date is downloaded.
+        """
         logging.info(f"Fetching CNB rates for {len(dates)} days")
-        for d in dates:
-            date_param = d.strftime('%d.%m.%Y')
-            raw_response = self.get_raw(f"{self.base_url}?date={date_param}", timeout=15)
-            raw_response.raise_for_status()
+        if not dates:
+            return
 
-            temp_date = self._parse_date(raw_response, d, today, curr_flag)
-            temp_data = self._parse_response(raw_response, temp_date, currencies)
-            data.extend(temp_data)
+        # Days are fetched concurrently, map() yields the results in the order of dates
+        executor = ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(dates)))
+        try:
+            yield from executor.map(lambda d: self._get_day_rates(d, today, curr_flag, currencies), dates)
+        finally:
+            # On failure the queued days are dropped instead of being fetched before the error propagates
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        return data
+    def _get_day_rates(self, d: date, today: date, curr_flag: bool,
+                       currencies: Optional[FrozenSet[str]]) -> List[Tuple[str, ...]]:
+        date_param = f"{d.day:02d}.{d.month:02d}.{d.year}"
+        raw_response = self.get_raw(f"{self.base_url}?date={date_param}", timeout=15)
+        raw_response.raise_for_status()
+
+        temp_date = self._parse_date(raw_response, d, today, curr_flag)
+        return self._parse_response(raw_response, temp_date, currencies)
@@ -1,8 +1,11 @@
 import csv
+import io
 import logging
+import os
+from contextlib import closing
 from datetime import datetime, timedelta, date
-import pytz
-from typing import List, Dict
+from typing import List, Dict, FrozenSet, Iterator, Optional, Tuple
+from zoneinfo import ZoneInfo
 
 from keboola.component.base import ComponentBase
 from keboola.component.exceptions import UserException
@@ -11,77 +14,175 @@ from client.client import CNBRatesClient, CNBRatesClientException
 from configuration import Configuration, ConfigurationException
 
 DEFAULT_OUTPUT_TABLE_NAME = 'cnb_rates'
+PRAGUE_TZ = ZoneInfo('Europe/Prague')
+OUTPUT_FILE_HEADER = ['date', 'country', 'currency', 'amount', 'code', 'rate']
+# Same line terminator as the default csv dialect, so both write paths produce identical files
+CSV_ROW_TEMPLATE = ','.join(['%s'] * len(OUTPUT_FILE_HEADER)) + '\r\n'
+OUTPUT_BUFFER_SIZE = 1 << 20
+OUTPUT_FORMAT_PARQUET = 'parquet'
+STATE_RATES_CACHE = 'rates_cache'
+RATES_CACHE_DAYS = 31
 
 
 class Component(ComponentBase):
     def __init__(self):
         super().__init__()
         self.client = None
+        # Date setters dictionary
+        # Keys represents values of "dates" option in the config.json
+        self._dates_setters: Dict[str, callable] = {
+            'Current day (currently declared rates)': self._set_today,
+            'Current day and yesterday': self._set_today_and_yesterday,
+            'Week': self._set_week,
+            'Custom date range': self._set_custom_date_range
+        }
 
     def run(self):
-        self.client = CNBRatesClient()
-        today: date = datetime.now(pytz.timezone('Europe/Prague')).date()
+        today: date = datetime.now(PRAGUE_TZ).date()
 
         params = Configuration(**self.configuration.parameters)
         dates_list = self._run_with_new_config(params, today)
+        self.client = CNBRatesClient()
         incr = True if params.destination.incremental == "incremental_load" else False
         out = params.destination.file_name or DEFAULT_OUTPUT_TABLE_NAME
-        currencies = params.currencies.selected_currencies
+        selected_currencies = params.currencies.selected_currencies
+        currencies = frozenset(selected_currencies) if selected_currencies is not None else None
 
-        logging.info(f'Currency data: {currencies}')
+        logging.info(f'Currency data: {selected_currencies}')
         logging.info(f'{len(dates_list)} dates added')
 
-        rates = self.client.get_rates(
-            dates_list,
-            today,
-            params.date_settings.current_as_today,
-            currencies
-        )
-
-        logging.info(f'{len(rates)} rates fetched')
+        # Closing the generator stops the pending downloads when writing the output fails
+        with closing(self._iter_rates(dates_list, today, params.date_settings.current_as_today, currencies)) as rates:
+            if params.destination.output_format == OUTPUT_FORMAT_PARQUET:
+                self._write_parquet_output(out, [row for day_rates in rates for row in day_rates])
+            else:
+                self._write_csv_output(out, incr, rates)
 
+    def _write_csv_output(self, out: str, incr: bool, rates: Iterator[List[Tuple[str, ...]]]) -> None:
         table = self.create_out_table_definition(
             name=f"{out}.csv",
             incremental=incr,
             primary_key=['date', 'code']
         )
 
-        if not rates:
+        # Rates are written day by day while the following days are still being downloaded
+        rates_count = 0
+        with open(table.full_path, mode='wt', encoding='utf-8', newline='',
+                  buffering=OUTPUT_BUFFER_SIZE) as out_file:
+            out_file.write(CSV_ROW_TEMPLATE % tuple(OUTPUT_FILE_HEADER))
+            for day_rates in rates:
+                self._write_rates(out_file, day_rates)
+                rates_count += len(day_rates)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+        logging.info(f'{rates_count} rates fetched')
+
+        if not rates_count:
             logging.warning('No rates fetched. No output will be generated.')
-        else:
-            file_header = ['date', 'country', 'currency', 'amount', 'code', 'rate']
-            with open(table.full_path, mode='wt', encoding='utf-8', newline='') as out_file:
-                writer = csv.writer(out_file)
-                writer.writerow(file_header)
-                writer.writerows(rates)
+            os.remove(table.full_path)
 
         self.write_manifest(table)
 
     def _run_with_new_config(self, params: Configuration, today: date):
         dates_list = []
-        date_action = self._get_dates_setters.get(params.date_settings.dates)
+        date_settings = params.date_settings
+        dates_choice = date_settings.dates
+        date_action = self._dates_setters.get(dates_choice)
 
         if not date_action:
-            raise UserException(f"No valid date action found for {params.date_settings.dates}")
-
-        if date_action:
-            if params.date_settings.dates == "Custom date range":
-                try:
-                    date_from: date = datetime.strptime(
-                        str(params.date_settings.dependent_date_from), '%Y-%m-%d'
-                    ).date()
-                    date_to: date = datetime.strptime(
-                        str(params.date_settings.dependent_date_to), '%Y-%m-%d'
-                    ).date()
-                    dates_list = date_action(dates_list, today, date_from, date_to)
-
-                except ValueError:
-                    raise UserException('Dates not specified correctly for custom date range!')
-            else:
-                dates_list = date_action(dates_list, today)
+            raise UserException(f"No valid date action found for {dates_choice}")
+
+        if dates_choice == "Custom date range":
+            # Dates are already parsed and validated by the Configuration model
+            date_from: Optional[date] = date_settings.dependent_date_from
+            date_to: Optional[date] = date_settings.dependent_date_to
+            if date_from is None or date_to is None:
+                raise UserException('Dates not specified correctly for custom date range!')
+
+            dates_list = date_action(dates_list, today, date_from, date_to)
+        else:
+            dates_list = date_action(dates_list, today)
 
         return dates_list
 
+    def _iter_rates(self, dates_list: List[date], today: date, curr_flag: bool,
+                    currencies: Optional[FrozenSet[str]]) -> Iterator[List[Tuple[str, ...]]]:
+        """
+        Yields rates of each date in the order of dates_list. Rates declared before today never change, so they are
+        kept in the state file and only the dates missing there (and today) are fetched from CNB. The cache is valid
+        only for the same currency selection and keeps just the dates of the current run within the last
+        RATES_CACHE_DAYS days, so the state stays small even for long custom ranges.
+        """
+        cache_from = today - timedelta(days=RATES_CACHE_DAYS)
+        cache_currencies = sorted(currencies) if currencies is not None else None
+        cache = self.get_state_file().get(STATE_RATES_CACHE, {})
+        cached_rates = {}
+        if cache.get('currencies') == cache_currencies:
+            # Rows are stored as JSON arrays, the writers expect the same tuples the client returns
+            cached_rates = {day: [tuple(row) for row in rows] for day, rows in cache.get('rates', {}).items()}
+
+        to_fetch = [d for d in dates_list if d >= today or d.isoformat() not in cached_rates]
+        logging.info(f'{len(dates_list) - len(to_fetch)} dates loaded from cache')
+        fetched_rates = self.client.iter_rates(to_fetch, today, curr_flag, currencies)
+
+        new_cache = {}
+        try:
+            for d in dates_list:
+                day_rates = cached_rates.get(d.isoformat()) if d < today else None
+                if day_rates is None:
+                    day_rates = next(fetched_rates)
+                # An empty day is most likely a failed response, so it is fetched again on the next run
+                if cache_from <= d < today and day_rates:
+                    new_cache[d.isoformat()] = day_rates
+                yield day_rates
+        finally:
+            fetched_rates.close()
+
+        self.write_state_file({STATE_RATES_CACHE: {'currencies': cache_currencies, 'rates': new_cache}})
+
+    def _write_parquet_output(self, out: str, rates: List[Tuple[str, ...]]) -> None:
+        if not rates:
+            logging.warning('No rates fetched. No output will be generated.')
+            return
+
+        # pyarrow is imported lazily, so CSV runs do not pay for its import
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([
+            ('date', pa.date32()),
+            ('country', pa.string()),
+            ('currency', pa.string()),
+            ('amount', pa.int32()),
+            ('code', pa.string()),
+            ('rate', pa.float64())
+        ])
+        columns = [pa.array(column, pa.string()).cast(field.type) for column, field in zip(zip(*rates), schema)]
+
+        out_file = self.create_out_file_definition(name=f"{out}.parquet", tags=['cnb_rates'])
+        pq.write_table(pa.Table.from_arrays(columns, schema=schema), out_file.full_path, compression='snappy')
+        self.write_manifest(out_file)
+
+    @staticmethod
+    def _write_rates(out_file, rates: List[Tuple[str, ...]]) -> None:
+        """
+        Writes rates rows to the output file. Rates rows are plain values which never need quoting,
+        so the whole batch is formatted at once. The csv module is used only if some value needs quoting,
+        and even then the batch is rendered in memory and written in one call.
+        """
+        body = ''.join([CSV_ROW_TEMPLATE % row for row in rates])
+
+        # Any delimiter, quote or line break inside a value shows up as an extra character in the formatted body
+        rows_count = len(rates)
+        if (body.count(',') != rows_count * (len(OUTPUT_FILE_HEADER) - 1) or '"' in body
+                or body.count('\n') != rows_count or body.count('\r') != rows_count):
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rates)
+            body = buffer.getvalue()
+
+        out_file.write(body)
+
     # Date setters
     @staticmethod
     def _set_date_range(dates_list: List, day: date, days: int) -> List:
@@ -89,10 +190,8 @@ class Component(ComponentBase):
             logging.error(f"Invalid number of days: {days}. Must be positive.")
             raise UserException(f"Invalid number of days: {days}.")
 
-        for i in range(days):
-            date_to_add = day - timedelta(days=i)
-            dates_list.append(date_to_add)
-            logging.info(f"Added date: {date_to_add}")
+        dates_list.extend([day - timedelta(days=i) for i in range(days)])
+        logging.info(f"Added {days} dates: {day - timedelta(days=days - 1)} - {day}")
         return dates_list
 
     def _set_today(self, dates_list: List, today: date) -> List:
@@ -133,26 +232,12 @@ class Component(ComponentBase):
             )
             date_to = today
 
-        for i in range((date_to - date_from).days + 1):
-            date_to_add = date_from + timedelta(days=i)
-            dates_list.append(date_to_add)
-            logging.info(f"Added date: {date_to_add}")
+        days = (date_to - date_from).days + 1
+        dates_list.extend([date_from + timedelta(days=i) for i in range(days)])
+        logging.info(f"Added {days} dates: {date_from} - {date_to}")
 
         return dates_list
 
-    # Date setters dictionary
-    # Keys represents values of "dates" option in the config.json
-    @property
-    def _get_dates_setters(self) -> Dict[str, callable]:
-
-        setters = {
-            'Current day (currently declared rates)': self._set_today,
-            'Current day and yesterday': self._set_today_and_yesterday,
-            'Week': self._set_week,
-            'Custom date range': self._set_custom_date_range
-        }
-        return setters
-
 
 if __name__ == "__main__":
     try:
@@ -161,7 +246,7 @@ if __name__ == "__main__":
         comp.execute_action()
 
     except (CNBRatesClientException, ConfigurationException) as exc:
-        raise UserException(exc)
+        raise UserException(str(exc)) from exc
 
     except UserException as exc:
         logging.exception(exc)
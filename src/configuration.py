@@ -1,6 +1,6 @@
 import logging
 
-from typing import Optional
+from typing import Literal, Optional
 from datetime import date
 
 from pydantic import BaseModel, Field, ValidationError
@@ -17,6 +17,7 @@ class DestinationConfig(BaseModel):
         default="output",
     )
     incremental: str = Field(title="Load type", default="full_load")
+    output_format: Literal["csv", "parquet"] = Field(title="Output format", default="csv")
 
 
 class DateSettingsConfig(BaseModel):
@@ -0,0 +1,94 @@
+import threading
+import time
+import unittest
+import mock
+from datetime import date, timedelta
+
+from requests import HTTPError
+
+from client.client import CNBRatesClient, MAX_WORKERS
+
+TODAY = date(2010, 10, 10)
+RESPONSE_TEXT = ("08.10.2010 #196\n"
+                 "země|měna|množství|kód|kurz\n"
+                 "EMU|euro|1|EUR|24,560\n"
+                 "USA|dolar|1|USD|18,010\n")
+
+
+def fake_response(text=RESPONSE_TEXT, error=None):
+    response = mock.Mock(text=text)
+    if error:
+        response.raise_for_status.side_effect = error
+    return response
+
+
+class TestCNBRatesClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = CNBRatesClient()
+
+    def test_iter_rates_keeps_order_of_dates(self):
+        dates = [TODAY - timedelta(days=i) for i in range(1, 6)]
+
+        def get_raw(url, **kwargs):
+            # Older dates are requested later but finish first
+            time.sleep(0.01 * (TODAY - date.fromisoformat(url[-4:] + '-' + url[-7:-5] + '-' + url[-10:-8])).days)
+            return fake_response()
+
+        with mock.patch.object(self.client, 'get_raw', side_effect=get_raw):
+            rates = list(self.client.iter_rates(dates, TODAY, True, frozenset(['EUR'])))
+
+        self.assertEqual(rates, [[(d.isoformat(), 'EMU', 'euro', '1', 'EUR', '24.560')] for d in dates])
+
+    def test_iter_rates_without_dates_does_not_fetch(self):
+        with mock.patch.object(self.client, 'get_raw') as get_raw:
+            self.assertEqual(list(self.client.iter_rates([], TODAY, True, None)), [])
+        get_raw.assert_not_called()
+
+    def test_iter_rates_raises_http_error(self):
+        with mock.patch.object(self.client, 'get_raw', return_value=fake_response(error=HTTPError('503'))):
+            with self.assertRaises(HTTPError):
+                list(self.client.iter_rates([TODAY - timedelta(days=1)], TODAY, True, None))
+
+    def test_iter_rates_does_not_fetch_queued_days_after_failure(self):
+        dates = [TODAY - timedelta(days=i) for i in range(1, 61)]
+        fetched_urls = []
+        lock = threading.Lock()
+
+        def get_raw(url, **kwargs):
+            with lock:
+                fetched_urls.append(url)
+            if url.endswith(dates[0].strftime('%d.%m.%Y')):
+                return fake_response(error=HTTPError('500'))
+            time.sleep(0.01)
+            return fake_response()
+
+        with mock.patch.object(self.client, 'get_raw', side_effect=get_raw):
+            with self.assertRaises(HTTPError):
+                list(self.client.iter_rates(dates, TODAY, True, None))
+            fetched_after_failure = len(fetched_urls)
+            time.sleep(0.2)
+
+        # Only the days already being downloaded may finish, the queued ones are cancelled
+        self.assertLessEqual(len(fetched_urls), fetched_after_failure + MAX_WORKERS)
+        self.assertLess(len(fetched_urls), len(dates))
+
+    def test_iter_rates_requests_date_as_day_month_year(self):
+        day = date(2010, 1, 5)
+        with mock.patch.object(self.client, 'get_raw', return_value=fake_response()) as get_raw:
+            rates = list(self.client.iter_rates([day], TODAY, True, frozenset(['USD'])))
+
+        self.assertTrue(get_raw.call_args.args[0].endswith('denni_kurz.txt?date=05.01.2010'))
+        self.assertEqual(rates, [[('2010-01-05', 'USA', 'dolar', '1', 'USD', '18.010')]])
+
+    def test_iter_rates_dates_current_rates_by_declaration_date(self):
+        with mock.patch.object(self.client, 'get_raw', return_value=fake_response()):
+            declared = list(self.client.iter_rates([TODAY], TODAY, False, frozenset(['EUR'])))
+            as_today = list(self.client.iter_rates([TODAY], TODAY, True, frozenset(['EUR'])))
+
+        self.assertEqual(declared[0][0][0], '2010-10-08')
+        self.assertEqual(as_today[0][0][0], '2010-10-10')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,15 +3,44 @@ Created on 12. 11. 2018
 
 @author: esner
 '''
+import csv
+import io
+import json
+import tempfile
+import threading
+import time
 import unittest
 import mock
 import os
+from datetime import date, timedelta
+
+import pyarrow.parquet as pq
 from freezegun import freeze_time
 
-from component import Component
+from client.client import CNBRatesClient, MAX_WORKERS
+from component import Component, OUTPUT_FILE_HEADER, RATES_CACHE_DAYS, STATE_RATES_CACHE
+from configuration import Configuration, ConfigurationException
+
+
+def fake_iter_rates(empty_days=frozenset()):
+    """
+    Returns a replacement of CNBRatesClient.iter_rates yielding EUR and USD rates for each date,
+    except empty_days which yield no rates.
+    """
+    def iter_rates(dates, *args):
+        for d in dates:
+            yield [] if d in empty_days else [(d.isoformat(), 'EMU', 'euro', '1', 'EUR', '24.560'),
+                                              (d.isoformat(), 'USA', 'dolar', '1', 'USD', '18.010')]
+    return iter_rates
 
 
 class TestComponent(unittest.TestCase):
+    RUN_PARAMETERS = {
+        'currencies': {'selected_currencies': ['EUR']},
+        'destination': {'file_name': 'rates', 'incremental': 'full_load'},
+        'date_settings': {'dates': 'Custom date range', 'dependent_date_from': '2010-10-01',
+                          'dependent_date_to': '2010-10-03'}
+    }
 
     # set global time to 2010-10-10 - affects functions like datetime.now()
     @freeze_time("2010-10-10")
@@ -22,6 +51,143 @@ class TestComponent(unittest.TestCase):
             comp = Component()
             comp.run()
 
+    def test_write_rates_matches_csv_writer(self):
+        for rates in ([('2010-10-08', 'EMU', 'euro', '1', 'EUR', '24.560')],
+                      [('2010-10-08', 'Korea, Rep.', 'won "new"', '100', 'KRW', '1.575')]):
+            expected = io.StringIO()
+            csv.writer(expected).writerows(rates)
+
+            out_file = io.StringIO()
+            Component._write_rates(out_file, rates)
+            self.assertEqual(out_file.getvalue(), expected.getvalue())
+
+    @staticmethod
+    def _component_in(data_dir, parameters=None):
+        for folder in ('in', os.path.join('out', 'files'), os.path.join('out', 'tables')):
+            os.makedirs(os.path.join(data_dir, folder), exist_ok=True)
+        with open(os.path.join(data_dir, 'config.json'), 'w') as config_file:
+            json.dump({'parameters': parameters or {}}, config_file)
+
+        with mock.patch.dict(os.environ, {'KBC_DATADIR': data_dir}):
+            return Component()
+
+    def test_unknown_output_format_fails(self):
+        parameters = dict(self.RUN_PARAMETERS, destination={'file_name': 'rates', 'output_format': 'Parquet'})
+        with self.assertRaises(ConfigurationException):
+            Configuration(**parameters)
+
+    def test_write_parquet_output_is_typed(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            comp = self._component_in(data_dir)
+            comp._write_parquet_output('rates', [('2010-10-08', 'EMU', 'euro', '1', 'EUR', '24.560')])
+
+            table = pq.read_table(os.path.join(data_dir, 'out', 'files', 'rates.parquet'))
+            self.assertEqual(table.column_names, OUTPUT_FILE_HEADER)
+            self.assertEqual(table.column('amount').to_pylist(), [1])
+            self.assertEqual(table.column('rate').to_pylist(), [24.56])
+
+    def test_iter_rates_fetches_only_uncached_dates(self):
+        today = date(2010, 10, 10)
+        dates_list = [today - timedelta(days=i) for i in range(3)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            comp = self._component_in(data_dir)
+            comp.client = mock.Mock(iter_rates=mock.Mock(side_effect=fake_iter_rates()))
+            first_rates = list(comp._iter_rates(dates_list, today, True, frozenset(['EUR'])))
+            os.replace(os.path.join(data_dir, 'out', 'state.json'), os.path.join(data_dir, 'in', 'state.json'))
+
+            second_rates = list(comp._iter_rates(dates_list, today, True, frozenset(['EUR'])))
+            self.assertEqual(comp.client.iter_rates.call_args.args[0], [today])
+            self.assertEqual(second_rates, first_rates)
+
+            list(comp._iter_rates(dates_list, today, True, frozenset(['USD'])))
+            self.assertEqual(comp.client.iter_rates.call_args.args[0], dates_list)
+
+    def test_iter_rates_does_not_cache_empty_days(self):
+        today = date(2010, 10, 10)
+        empty_day = today - timedelta(days=1)
+        dates_list = [today - timedelta(days=i) for i in range(3)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            comp = self._component_in(data_dir)
+            comp.client = mock.Mock(iter_rates=mock.Mock(side_effect=fake_iter_rates({empty_day})))
+            list(comp._iter_rates(dates_list, today, True, frozenset(['EUR'])))
+            os.replace(os.path.join(data_dir, 'out', 'state.json'), os.path.join(data_dir, 'in', 'state.json'))
+
+            list(comp._iter_rates(dates_list, today, True, frozenset(['EUR'])))
+            self.assertEqual(comp.client.iter_rates.call_args.args[0], [today, empty_day])
+
+    def test_iter_rates_caches_only_recent_days(self):
+        today = date(2010, 10, 10)
+        dates_list = [today - timedelta(days=i) for i in range(RATES_CACHE_DAYS + 10)]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            comp = self._component_in(data_dir)
+            comp.client = mock.Mock(iter_rates=mock.Mock(side_effect=fake_iter_rates()))
+            list(comp._iter_rates(dates_list, today, True, frozenset(['EUR'])))
+
+            with open(os.path.join(data_dir, 'out', 'state.json')) as state_file:
+                cached_days = json.load(state_file)[STATE_RATES_CACHE]['rates']
+            self.assertEqual(sorted(cached_days), sorted(d.isoformat() for d in dates_list[1:RATES_CACHE_DAYS + 1]))
+
+    @freeze_time("2010-10-10")
+    def test_run_writes_header_and_days_in_order(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            comp = self._component_in(data_dir, self.RUN_PARAMETERS)
+            with mock.patch('component.CNBRatesClient') as client_cls:
+                client_cls.return_value.iter_rates.side_effect = fake_iter_rates()
+                comp.run()
+
+            with open(os.path.join(data_dir, 'out', 'tables', 'rates.csv'), newline='') as out_file:
+                rows = list(csv.reader(out_file))
+            self.assertEqual(rows[0], OUTPUT_FILE_HEADER)
+            self.assertEqual([row[0] for row in rows[1:]],
+                             ['2010-10-01', '2010-10-01', '2010-10-02', '2010-10-02', '2010-10-03', '2010-10-03'])
+            self.assertEqual([row[4] for row in rows[1:]], ['EUR', 'USD'] * 3)
+
+    @freeze_time("2010-10-10")
+    def test_run_without_rates_removes_csv(self):
+        empty_days = {date(2010, 10, 1), date(2010, 10, 2), date(2010, 10, 3)}
+        with tempfile.TemporaryDirectory() as data_dir:
+            comp = self._component_in(data_dir, self.RUN_PARAMETERS)
+            with mock.patch('component.CNBRatesClient') as client_cls:
+                client_cls.return_value.iter_rates.side_effect = fake_iter_rates(empty_days)
+                comp.run()
+
+            self.assertFalse(os.path.exists(os.path.join(data_dir, 'out', 'tables', 'rates.csv')))
+
+    def test_run_stops_fetching_when_writing_fails(self):
+        parameters = dict(self.RUN_PARAMETERS, date_settings={
+            'dates': 'Custom date range', 'dependent_date_from': '2010-08-01', 'dependent_date_to': '2010-09-29'})
+        fetched_days = []
+        lock = threading.Lock()
+
+        def get_day_rates(client, d, *args):
+            time.sleep(0.01)
+            with lock:
+                fetched_days.append(d)
+            return [(d.isoformat(), 'EMU', 'euro', '1', 'EUR', '24.560')]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            comp = self._component_in(data_dir, parameters)
+            with mock.patch.object(CNBRatesClient, '_get_day_rates', get_day_rates), \
+                    mock.patch.object(Component, '_write_rates', side_effect=OSError('disk full')):
+                # The error is kept with its traceback, so the frames of run() are not released like in assertRaises
+                error = None
+                try:
+                    comp.run()
+                except OSError as exc:
+                    error = exc
+
+                fetched_after_failure = len(fetched_days)
+                time.sleep(0.2)
+
+            self.assertIsNotNone(error)
+
+            # Only the days already being downloaded may finish, the queued ones are cancelled
+            self.assertLessEqual(len(fetched_days), fetched_after_failure + MAX_WORKERS)
+            self.assertLess(len(fetched_days), 60)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']